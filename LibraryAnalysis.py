@@ -193,6 +193,339 @@ def description_sheet(of_what):
     return description_rows, description_columns
 
 
+def core_compiler(column_sub_A, column_sub_B, properties):
+    """Function preparing compact core of all analyzed parameters
+
+    Substitution IDs are interned once into integer codes (position in the
+    returned substituents index) and every parameter is stored in a single
+    float32 array of shape (parameter, proximal, distal).
+
+    Parameters
+    ----------
+    column_sub_A : str
+        name of a column containing descriptors A (ring A substitution)
+    column_sub_B : str
+        name of a column containing descriptors B (ring B substitution)
+    properties : dict
+        parameter names mapped to pairs of columns with values A and B
+    Returns
+    -------
+    substituents: Index
+        Returns sorted substitution IDs, position in index is the integer code.
+    core: ndarray
+        Returns float32 array containing rectangular data for each parameter.
+    """
+    # Each substitution pattern can only fill a single cell
+    if library.duplicated([column_sub_A, column_sub_B]).any():
+        raise ValueError("Index contains duplicate entries, cannot reshape")
+
+    substituents = pd.Index(sorted(set(library[column_sub_A]) | set(library[column_sub_B])))
+    code_a = substituents.get_indexer(library[column_sub_A])
+    code_b = substituents.get_indexer(library[column_sub_B])
+
+    core = np.full((len(properties), len(substituents), len(substituents)), np.nan, dtype=np.float32)
+    ring_b = np.full((len(substituents), len(substituents)), np.nan, dtype=np.float32)
+    for p, (column_val_A, column_val_B) in enumerate(properties.values()):
+        core[p, code_a, code_b] = library[column_val_A].to_numpy(dtype=np.float32)
+        ring_b[code_a, code_b] = library[column_val_B].to_numpy(dtype=np.float32)
+        # Appending missing values from the other ring (compounds are symmetrical along short axis)
+        missing = np.isnan(core[p])
+        core[p][missing] = ring_b.T[missing]
+        ring_b.fill(np.nan)
+
+    return substituents, core
+
+
+def core_view(core, substituents, properties, name):
+    """Function exposing a single parameter of the core as a DataFrame
+
+    The DataFrame shares memory with the core, no data is copied.
+
+    Parameters
+    ----------
+    core : ndarray
+        array prepared by core_compiler or loaded by load_core
+    substituents : Index
+        substitution IDs returned together with the core
+    properties : list
+        parameter names in the order of the first core axis
+    name : str
+        name of the parameter to be exposed
+    Returns
+    -------
+    DataFrame
+        Returns dataframe containing rectangular data for heatmap.
+    """
+    view = pd.DataFrame(core[list(properties).index(name)],
+                        index=pd.Index(substituents, name='Proximal ring substitution'),
+                        columns=pd.Index(substituents, name='Distal ring substitution'),
+                        copy=False)
+    return view
+
+
+def core_charges(charges, substituents):
+    """Function aligning charges table with integer codes of the core
+
+    Parameters
+    ----------
+    charges : DataFrame
+        charges table for monosubstituted compounds
+    substituents : Index
+        substitution IDs returned together with the core
+    Returns
+    -------
+    DataFrame
+        Returns float32 dataframe with one row per integer code.
+    """
+    # Compounds substituted only on ring A or only on ring B give the same entry
+    charges = charges[~charges.index.duplicated()]
+    return charges.reindex(index=substituents).astype(np.float32)
+
+
+def save_core(path, core, substituents, properties, charges=None):
+    """Function saving the core as .npy with code tables stored next to it
+
+    Parameters
+    ----------
+    path : str
+        path of the .npy file
+    core : ndarray
+        array prepared by core_compiler
+    substituents : Index
+        substitution IDs returned together with the core
+    properties : list
+        parameter names in the order of the first core axis
+    charges : DataFrame or None
+        charges prepared by core_charges, saved as a separate .npy
+    """
+    base = os.path.splitext(path)[0]
+    np.save(path, core)
+    pd.DataFrame({'Substituent': substituents}).to_csv(base + '_substituents.csv', index_label='Code')
+    pd.DataFrame({'Property': list(properties)}).to_csv(base + '_properties.csv', index_label='Code')
+    if charges is not None:
+        np.save(base + '_charges.npy', charges.to_numpy(dtype=np.float32))
+        pd.DataFrame({'Atom': charges.columns}).to_csv(base + '_charge_atoms.csv', index_label='Code')
+
+
+def load_core(path, mmap_mode='r'):
+    """Function loading the core saved by save_core
+
+    Parameters
+    ----------
+    path : str
+        path of the .npy file
+    mmap_mode : str or None
+        passed to numpy.load, by default the core is memory-mapped read-only
+    Returns
+    -------
+    core: ndarray
+        Returns float32 array of shape (parameter, proximal, distal).
+    substituents: Index
+        Returns substitution IDs, position in index is the integer code.
+    properties: list
+        Returns parameter names in the order of the first core axis.
+    charges: DataFrame or None
+        Returns charges sharing memory with the saved array, None if not saved.
+    """
+    base = os.path.splitext(path)[0]
+    core = np.load(path, mmap_mode=mmap_mode)
+    substituents = pd.Index(pd.read_csv(base + '_substituents.csv', index_col=0,
+                                        keep_default_na=False)['Substituent'])
+    properties = list(pd.read_csv(base + '_properties.csv', index_col=0)['Property'])
+    charges = None
+    if os.path.exists(base + '_charges.npy'):
+        atoms = pd.read_csv(base + '_charge_atoms.csv', index_col=0)['Atom']
+        charges = pd.DataFrame(np.load(base + '_charges.npy', mmap_mode=mmap_mode),
+                               index=substituents, columns=list(atoms), copy=False)
+    return core, substituents, properties, charges
+
+
+def substituent_fingerprints(core, substituents, properties, charges, scaling=None):
+    """Function building standardized property fingerprints for each substitution pattern
+
+        Parameters
+        ----------
+        core : ndarray
+            array prepared by core_compiler or loaded by load_core
+        substituents : Index
+            substitution IDs returned together with the core
+        properties : list
+            parameter names in the order of the first core axis
+        charges : DataFrame
+            charges prepared by core_charges for the same substitution IDs
+        scaling : DataFrame or None
+            standardization returned by a previous call, used to put new candidates
+            on the same scale as the library; fitted on the given data when None
+
+        Returns
+        -------
+        fingerprints: DataFrame
+            Returns dataframe with one standardized fingerprint per substitution pattern.
+        scaling: DataFrame
+            Returns mean and standard deviation of each fingerprint feature.
+        """
+    # Row of every parameter for the proximal substitution, followed by its charges
+    values = np.hstack([core.transpose(1, 0, 2).reshape(len(substituents), -1),
+                        charges.to_numpy(dtype=np.float32)])
+    columns = pd.MultiIndex.from_tuples(
+        [(name, distal) for name in properties for distal in substituents]
+        + [('Charges', atom) for atom in charges.columns])
+
+    if scaling is None:
+        # Constant or missing features do not contribute to distance
+        mean = np.nanmean(values, axis=0)
+        deviation = np.nanstd(values, axis=0)
+        deviation[~(deviation > 0)] = 1
+        scaling = pd.DataFrame([mean, deviation], index=['Mean', 'Standard deviation'],
+                               columns=columns)
+    else:
+        values = pd.DataFrame(values, columns=columns).reindex(columns=scaling.columns).to_numpy()
+
+    fingerprints = (values - scaling.loc['Mean'].to_numpy()) \
+        / scaling.loc['Standard deviation'].to_numpy()
+    fingerprints = pd.DataFrame(np.nan_to_num(fingerprints, nan=0.0), index=substituents,
+                                columns=scaling.columns)
+
+    return fingerprints, scaling
+
+
+def distance_blocks(fingerprints, candidates, block_size=512):
+    """Function computing squared euclidean distances block by block
+
+        Parameters
+        ----------
+        fingerprints : ndarray
+            standardized fingerprints of the library
+        candidates : ndarray
+            standardized fingerprints of the candidates, in the same feature order
+        block_size : int
+            number of candidates processed at once, limits memory use
+            to block_size x number of substitution patterns distances
+
+        Yields
+        ------
+        start: int
+            position of the first candidate in the block
+        block: ndarray
+            squared distances of the block candidates to all substitution patterns
+        """
+    squared_norms = np.einsum('ij,ij->i', fingerprints, fingerprints)
+    candidate_norms = np.einsum('ij,ij->i', candidates, candidates)
+    for start in range(0, len(candidates), block_size):
+        stop = min(start + block_size, len(candidates))
+        block = candidate_norms[start:stop, None] + squared_norms[None, :] \
+            - 2 * candidates[start:stop] @ fingerprints.T
+        np.maximum(block, 0, out=block)
+        yield start, block
+
+
+def query_substituents(fingerprints, candidates, k=5, block_size=512):
+    """Function finding k substitution patterns most similar to each candidate
+
+        A candidate present in the library under the same name is never
+        returned as its own neighbour.
+
+        Parameters
+        ----------
+        fingerprints : DataFrame
+            standardized fingerprints of the library from substituent_fingerprints
+        candidates : DataFrame
+            standardized fingerprints of the candidates, scaled with the library scaling
+        k : int
+            number of neighbours returned for each candidate
+        block_size : int
+            number of candidates processed at once
+
+        Returns
+        -------
+        neighbours: DataFrame
+            Returns dataframe containing names of the nearest substitution patterns.
+        distances: DataFrame
+            Returns dataframe containing euclidean distances to them.
+        """
+    values = fingerprints.to_numpy(dtype=float)
+    names = fingerprints.index.to_numpy()
+    queries = candidates.reindex(columns=fingerprints.columns).fillna(0).to_numpy(dtype=float)
+    self_codes = fingerprints.index.get_indexer(candidates.index)
+    k = min(k, len(values) - np.any(self_codes >= 0))
+
+    neighbour_idx = np.empty((len(queries), k), dtype=np.intp)
+    neighbour_dist = np.empty((len(queries), k))
+    for start, block in distance_blocks(values, queries, block_size):
+        stop = start + len(block)
+        # Excluding candidates already present in the library
+        rows = np.flatnonzero(self_codes[start:stop] >= 0)
+        block[rows, self_codes[start:stop][rows]] = np.inf
+        nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+        nearest_dist = np.take_along_axis(block, nearest, axis=1)
+        order = np.argsort(nearest_dist, axis=1)
+        neighbour_idx[start:stop] = np.take_along_axis(nearest, order, axis=1)
+        neighbour_dist[start:stop] = np.sqrt(np.take_along_axis(nearest_dist, order, axis=1))
+
+    columns = range(1, k + 1)
+    neighbours = pd.DataFrame(names[neighbour_idx], index=candidates.index, columns=columns)
+    distances = pd.DataFrame(neighbour_dist, index=candidates.index, columns=columns)
+    return neighbours, distances
+
+
+def nearest_substituents(fingerprints, k=5, block_size=512):
+    """Function finding k most similar substitution patterns for each substitution pattern
+
+        Parameters
+        ----------
+        fingerprints : DataFrame
+            standardized fingerprints from substituent_fingerprints
+        k : int
+            number of neighbours returned for each substitution pattern
+        block_size : int
+            number of substitution patterns processed at once
+
+        Returns
+        -------
+        neighbours: DataFrame
+            Returns dataframe containing names of the nearest substitution patterns.
+        distances: DataFrame
+            Returns dataframe containing euclidean distances to them.
+        """
+    return query_substituents(fingerprints, fingerprints, k=k, block_size=block_size)
+
+
+def neighbour_chain_order(fingerprints, block_size=512):
+    """Function ordering substitution patterns as a nearest-neighbour chain
+
+        The chain starts from the pattern most distant from the library mean
+        and always moves to the nearest pattern not yet visited, so that
+        similar patterns end up adjacent on reordered heatmap axes.
+
+        Parameters
+        ----------
+        fingerprints : DataFrame
+            standardized fingerprints from substituent_fingerprints
+        block_size : int
+            number of substitution patterns processed at once
+
+        Returns
+        -------
+        list
+            Returns list of substitution pattern names in chain order.
+        """
+    values = fingerprints.to_numpy(dtype=float)
+    distances = np.empty((len(values), len(values)))
+    for start, block in distance_blocks(values, values, block_size):
+        distances[start:start + len(block)] = block
+    centered = values - values.mean(axis=0)
+    current = int(np.argmax(np.einsum('ij,ij->i', centered, centered)))
+
+    order = [current]
+    distances[:, current] = np.inf
+    for _ in range(1, len(values)):
+        current = int(np.argmin(distances[current]))
+        order.append(current)
+        distances[:, current] = np.inf
+
+    return list(fingerprints.index[order])
+
+
 # !!!!!!!!!!!!!!!!Main file!!!!!!!!!!!!!!!!!!!!!!!
 os.mkdir(r'./ChargeDist')
 library = pd.read_csv("ScanLibrary.csv", index_col=0, header=0)
@@ -204,46 +537,34 @@ for x in range(0, len(library)):
     if library.iloc[x, -2] == "None,None":
         library.iloc[x, -2] = "None"
 
-library_act_ene = sub_library_compiler('A ring substitution ID',
-                                       'B ring substitution ID',
-                                       'Activation energy - bridge A',
-                                       'Activation energy - bridge B')
-library_sec_min = sub_library_compiler('A ring substitution ID',
-                                       'B ring substitution ID',
-                                       'Second minimum - bridge A',
-                                       'Second minimum - bridge B')
-library_OH_length = sub_library_compiler('A ring substitution ID',
-                                         'B ring substitution ID',
-                                         'Ring A starting lenght',
-                                         'Ring B starting lenght')
-library_N_charges = sub_library_compiler('A ring substitution ID',
-                                         'B ring substitution ID',
-                                         'Bridge A nitrogen charge',
-                                         'Bridge B nitrogen charge')
-library_O_charges = sub_library_compiler('A ring substitution ID',
-                                         'B ring substitution ID',
-                                         'Bridge A oxygen charge',
-                                         'Bridge B oxygen charge')
-library_C5_charges = sub_library_compiler('A ring substitution ID',
-                                          'B ring substitution ID',
-                                          'A ring carbon 5 Hirschfeld charge',
-                                          'B ring carbon 5 Hirschfeld charge')
-library_conectorC_charges = sub_library_compiler('A ring substitution ID',
-                                                 'B ring substitution ID',
-                                                 'Connector carbon A Mulliken charge',
-                                                 'Connector carbon B Mulliken charge')
-library_NO_dist = sub_library_compiler('A ring substitution ID',
-                                       'B ring substitution ID',
-                                       'Bridge A nitrogen - oxygen distance',
-                                       'Bridge B nitrogen - oxygen distance')
-library_NC_dist = sub_library_compiler('A ring substitution ID',
-                                       'B ring substitution ID',
-                                       'Bridge A nitrogen - carbon 1 distance',
-                                       'Bridge B nitrogen - carbon 1 distance')
-library_CO_dist = sub_library_compiler('A ring substitution ID',
-                                       'B ring substitution ID',
-                                       'Bridge A carbon 4  - oxygen distance',
-                                       'Bridge B carbon 4  - oxygen distance')
+# Compiling all numeric parameters into a single core with integer-coded substitution IDs
+core_properties = {
+    'Activation energy': ('Activation energy - bridge A', 'Activation energy - bridge B'),
+    'Second minimum': ('Second minimum - bridge A', 'Second minimum - bridge B'),
+    'O-H length': ('Ring A starting lenght', 'Ring B starting lenght'),
+    'N charge': ('Bridge A nitrogen charge', 'Bridge B nitrogen charge'),
+    'O charge': ('Bridge A oxygen charge', 'Bridge B oxygen charge'),
+    'C5 charge': ('A ring carbon 5 Hirschfeld charge', 'B ring carbon 5 Hirschfeld charge'),
+    'Connector C charge': ('Connector carbon A Mulliken charge', 'Connector carbon B Mulliken charge'),
+    'N-O distance': ('Bridge A nitrogen - oxygen distance', 'Bridge B nitrogen - oxygen distance'),
+    'N-C distance': ('Bridge A nitrogen - carbon 1 distance', 'Bridge B nitrogen - carbon 1 distance'),
+    'C-O distance': ('Bridge A carbon 4  - oxygen distance', 'Bridge B carbon 4  - oxygen distance')
+}
+core_substituents, library_core = core_compiler('A ring substitution ID',
+                                                'B ring substitution ID',
+                                                core_properties)
+
+library_act_ene = core_view(library_core, core_substituents, core_properties, 'Activation energy')
+library_sec_min = core_view(library_core, core_substituents, core_properties, 'Second minimum')
+library_OH_length = core_view(library_core, core_substituents, core_properties, 'O-H length')
+library_N_charges = core_view(library_core, core_substituents, core_properties, 'N charge')
+library_O_charges = core_view(library_core, core_substituents, core_properties, 'O charge')
+library_C5_charges = core_view(library_core, core_substituents, core_properties, 'C5 charge')
+library_conectorC_charges = core_view(library_core, core_substituents, core_properties,
+                                      'Connector C charge')
+library_NO_dist = core_view(library_core, core_substituents, core_properties, 'N-O distance')
+library_NC_dist = core_view(library_core, core_substituents, core_properties, 'N-C distance')
+library_CO_dist = core_view(library_core, core_substituents, core_properties, 'C-O distance')
 sub_position = sub_library_compiler('A ring substitution ID', 'B ring substitution ID',
                                     'Ring A substituted in postion',
                                     'Ring B substituted in postion')
@@ -255,6 +576,8 @@ sub_group = sub_library_compiler('A ring substitution ID', 'B ring substitution
 # Preparing charge tables for proximal substitution
 
 charge_H_table = sub_library_compiler_charges()
+charge_H_core = core_charges(charge_H_table, core_substituents)
+save_core("LibraryCore.npy", library_core, core_substituents, core_properties, charge_H_core)
 
 # Drawing images of charges distribution in the proximal part for each sub. pattern
 for x in range(0, len(charge_H_table)):
@@ -532,7 +855,9 @@ for x in range(0, len(sub_position)):
 for x in range(0, len(sub_position)):
     sub_position.iloc[:, x] = sub_position.iloc[:, x].astype('int')
 
-activation_energy_unsub = library_act_ene.loc['None', 'None']
+unsubstituted_code = core_substituents.get_loc('None')
+activation_energy_unsub = library_core[list(core_properties).index('Activation energy'),
+                                       unsubstituted_code, unsubstituted_code]
 
 # Difference between Activation energy and second minimum of proton transfer
 differences_of_ene = library_conectorC_charges.copy()  # Placeholder
@@ -578,6 +903,14 @@ statistical.append(proximal_effect_carbon5_charges.rename(
     columns={'Mean activation energy [kcal/mol]': 'Charge on C'}))
 pd.concat(statistical).to_csv("Statistical_C5_charges.csv", index=False)
 
+# Finding substitution patterns with similar properties
+fingerprints, fingerprint_scaling = substituent_fingerprints(library_core, core_substituents,
+                                                             core_properties, charge_H_core)
+similar_names, similar_distances = nearest_substituents(fingerprints, k=5)
+pd.concat([similar_names, similar_distances], axis=1, keys=['Substituent', 'Distance']) \
+    .to_csv("Similar_substituents.csv")
+similarity_ordering = neighbour_chain_order(fingerprints)
+
 # Drawing plots
 fig, axes = plt.subplots(2, 3, figsize=(17, 10))
 
@@ -678,4 +1011,22 @@ plt.subplots_adjust(left=0.1,
                     wspace=0.16,
                     hspace=0.28)
 plt.savefig("figure3.png")
+
+# Heatmaps with axes ordered by substituent similarity
+fig4, axes = plt.subplots(1, 2, figsize=(17, 7))
+sns.heatmap(library_act_ene.reindex(index=similarity_ordering, columns=similarity_ordering),
+            cmap='Reds', ax=axes[0], vmin=5, vmax=10)
+axes[0].set_title('Activation energy [kcal/mol]')
+
+sns.heatmap(library_sec_min.reindex(index=similarity_ordering, columns=similarity_ordering),
+            cmap='Blues', ax=axes[1], vmin=3, vmax=8)
+axes[1].set_title('Second minimum [kcal/mol]')
+axes[1].set(ylabel='')
+
+plt.subplots_adjust(left=0.1,
+                    bottom=0.2,
+                    right=0.948,
+                    top=0.94,
+                    wspace=0.16)
+plt.savefig("figure4.png")
 print("Done")